@@ -1,24 +1,49 @@
 from fastapi import FastAPI, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from bs4 import BeautifulSoup
-import requests
-from io import BytesIO
+from fastapi.responses import ORJSONResponse, Response
+import httpx
+from lxml import etree, html as lhtml
+import asyncio
+import functools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import logging
 import os
+import re
 import secrets
-from datetime import datetime, timedelta
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="TimeTable & Attendance Backend", version="3.0.0")
-
-@app.on_event("startup")
-async def startup_event():
+@asynccontextmanager
+async def lifespan(app):
     logger.info("✅ FastAPI app starting...")
     logger.info(f"Environment: PORT={os.getenv('PORT', '8000')}")
+    # Shared connection pool to the ERP, so TLS handshakes are paid once per
+    # worker instead of once per captcha flow. Created here so it is bound
+    # to the event loop that serves requests.
+    app.state.erp_transport = httpx.AsyncHTTPTransport(
+        http2=True,  # one multiplexed connection can carry many users' flows
+        retries=2,  # connection failures only; requests are never replayed
+        limits=httpx.Limits(
+            max_connections=128, max_keepalive_connections=32, keepalive_expiry=60.0
+        ),
+    )
+    warmup = asyncio.create_task(warm_erp_pool())
+    sweeper = asyncio.create_task(sweep_expired_sessions())
+    yield
+    sweeper.cancel()
+    warmup.cancel()
+    await app.state.erp_transport.aclose()
+
+app = FastAPI(
+    title="TimeTable & Attendance Backend",
+    version="3.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 # Health check root route
 @app.get("/")
@@ -32,93 +57,195 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     expose_headers=["X-Session-ID"], # Expose the custom header
+    max_age=86400, # Let browsers reuse a preflight for a day (they cap it lower)
 )
 
-# Session-based CAPTCHA store
-captcha_sessions = {}
+# Upstream ERP endpoints, built once at import time
+ERP_BASE_URL = "https://newerp.kluniversity.in"
+ERP_LOGIN_URL = f"{ERP_BASE_URL}/index.php?r=site%2Flogin"
+ERP_INDEX_URL = f"{ERP_BASE_URL}/index.php"
+ERP_TIMETABLE_ROUTE = "timetables/universitymasteracademictimetableview/individualstudenttimetableget"
+ERP_ATTENDANCE_URL = f"{ERP_BASE_URL}/index.php?r=studentattendance%2Fstudentdailyattendance%2Fcourselist"
+
+ERP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+# Per-flow client: its own cookie jar on top of the shared pool.
+# Never close it - that would close the shared transport for everyone.
+# Stored cookies are re-added with their original domain and path, so the
+# fresh PHPSESSID the ERP sets on login replaces the old one instead of
+# being sent alongside it (PHP reads the first, stale one).
+def erp_client(cookies=()):
+    client = httpx.AsyncClient(
+        transport=app.state.erp_transport,
+        headers=ERP_HEADERS,
+        timeout=30.0,
+        follow_redirects=True,
+        trust_env=False,
+    )
+    for name, value, domain, path in cookies:
+        client.cookies.set(name, value, domain=domain, path=path)
+    return client
+
+class UpstreamError(Exception):
+    """The ERP could not be reached or answered with an error status."""
+
+# Single place that turns transport failures and 4xx/5xx answers into UpstreamError
+async def erp_request(client, method, url, **kwargs):
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        raise UpstreamError(f"{method} {url}: {e}") from e
+    if response.status_code >= 400:
+        raise UpstreamError(f"{method} {url}: HTTP {response.status_code}")
+    return response
+
+# Shared error handling for the ERP routes: HTTPExceptions pass through,
+# ERP failures and anything unexpected become a logged 500
+def upstream_error_boundary(network_detail, internal_detail="Internal server error"):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await handler(*args, **kwargs)
+            except HTTPException:
+                raise
+            except UpstreamError as e:
+                logger.error(f"Network error in {handler.__name__}: {e}")
+                raise HTTPException(status_code=500, detail=network_detail)
+            except Exception as e:
+                logger.error(f"Unexpected error in {handler.__name__}: {e}", exc_info=True)
+                raise HTTPException(status_code=500, detail=internal_detail)
+        return wrapper
+    return decorator
+
+# Open the pooled connection up front so the first captcha flows after a
+# deploy skip the TCP+TLS handshake. Over HTTP/2 concurrent requests all
+# share one pending connection, so a single request is all it takes.
+async def warm_erp_pool():
+    try:
+        await erp_client().head(f"{ERP_BASE_URL}/")
+    except httpx.HTTPError as e:
+        logger.warning(f"ERP warm-up failed: {e}")
+    else:
+        logger.info("ERP warm-up: connection ready")
+
+# Pulled straight from the raw body - no need to build a DOM for one tag
+CSRF_RE = re.compile(rb'<meta[^>]+name="csrf-token"[^>]+content="([^"]+)"')
+CAPTCHA_IMG_RE = re.compile(rb'<img[^>]+src="([^"]*r=site%2Fcaptcha[^"]*)"')
+
+# The ERP serves UTF-8; parsing bytes with a fixed encoding skips decoding to str
+HTML_PARSER = lhtml.HTMLParser(encoding="utf-8")
+
+# Table lookups, compiled once instead of on every .xpath() call
+TABLE_HEADER_CELLS = etree.XPath("./thead//th")
+TABLE_BODY_ROWS = etree.XPath("./tbody/tr")
+GRID_VIEW_DIVS = etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " grid-view ")]')
+
+# Cut an ERP page down to the region we read, so libxml2 skips the nav,
+# scripts and footer around it. Runs from the first start_marker up to the
+# last </table>, so nested tables stay intact; falls back to the whole body.
+def table_region(body, start_marker=b"<table"):
+    start = body.find(start_marker)
+    end = body.rfind(b"</table>")
+    if start == -1 or end < start:
+        return body
+    if start_marker != b"<table":
+        # Back up to the tag that carries the marker, e.g. <div class="grid-view">
+        start = max(body.rfind(b"<", 0, start), 0)
+    return body[start:end + len(b"</table>")]
+
+# Session-based CAPTCHA store: (name, value, domain, path) cookie tuples +
+# CSRF token, no open connections or cookie jars.
+# Every entry gets the same TTL, so insertion order is also expiry order:
+# the oldest session is always at the front.
+# Only touched from the event loop, never across an await, so it needs no
+# lock. It is per-process, so the Procfile pins --workers 1 (overriding
+# WEB_CONCURRENCY); keep it that way until sessions move to a shared store.
+captcha_sessions = OrderedDict()
+SESSION_TTL = 600  # seconds
+SWEEP_INTERVAL = 60  # seconds
+MAX_CAPTCHA_SESSIONS = 10_000
 
 # Clean up expired sessions (older than 10 minutes)
 def cleanup_expired_sessions():
     try:
-        current_time = datetime.now()
-        expired_sessions = []
-        for session_id, data in captcha_sessions.items():
-            if current_time - data["created_at"] > timedelta(minutes=10):
-                expired_sessions.append(session_id)
+        now = time.monotonic()
+        expired = 0
+        while captcha_sessions:
+            oldest = next(iter(captcha_sessions.values()))
+            if oldest["expires_at"] > now:
+                break
+            captcha_sessions.popitem(last=False)
+            expired += 1
         
-        for session_id in expired_sessions:
-            del captcha_sessions[session_id]
-        
-        if expired_sessions:
-            logger.info(f"Cleaned up {len(expired_sessions)} expired sessions")
+        if expired:
+            logger.info(f"Cleaned up {expired} expired sessions")
     except Exception as e:
         logger.error(f"Error cleaning up sessions: {e}")
 
+# Runs off the request path; handlers never pay for cleanup
+async def sweep_expired_sessions():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        cleanup_expired_sessions()
+
 # ------------------ CAPTCHA ROUTE ------------------
 @app.get("/get-captcha")
-def get_captcha():
+@upstream_error_boundary("Network error while fetching CAPTCHA")
+async def get_captcha():
     """
     Establishes a session, triggers a CAPTCHA, and returns the
     image along with a session ID for the client to use in subsequent requests.
     """
-    cleanup_expired_sessions()
-    try:
-        session = requests.Session()
-        base_url = "https://newerp.kluniversity.in"
-        login_url = f"{base_url}/index.php?r=site%2Flogin"
-        headers = {"User-Agent": "Mozilla/5.0"}
-
-        # Step 1: Get initial page and CSRF token
-        logger.info("Fetching login page and CSRF token...")
-        res = session.get(login_url, headers=headers, timeout=30)
-        res.raise_for_status()
-        soup = BeautifulSoup(res.text, "html.parser")
-        csrf_meta = soup.find("meta", {"name": "csrf-token"})
-        if not csrf_meta:
-            raise HTTPException(status_code=500, detail="Failed to get CSRF token")
-        csrf = csrf_meta["content"]
-
-        # Step 2: Trigger CAPTCHA with a dummy POST request
-        logger.info("Triggering CAPTCHA with a dummy request...")
-        dummy_data = {"_csrf": csrf, "LoginForm[username]": "", "LoginForm[password]": ""}
-        res_post = session.post(login_url, data=dummy_data, headers=headers, timeout=30)
-        res_post.raise_for_status()
-        soup_post = BeautifulSoup(res_post.text, "html.parser")
-
-        # Step 3: Extract CAPTCHA URL from the new page content
-        captcha_img_tag = soup_post.find("img", src=lambda x: x and "r=site%2Fcaptcha" in x)
-        if not captcha_img_tag:
-             raise HTTPException(status_code=500, detail="CAPTCHA image not found after trigger.")
-
-        captcha_url = base_url + captcha_img_tag["src"].replace("&amp;", "&")
-        logger.info(f"Fetching CAPTCHA from: {captcha_url}")
-        captcha_response = session.get(captcha_url, timeout=30)
-        captcha_response.raise_for_status()
-
-        # Step 4: Create and store session
-        session_id = secrets.token_urlsafe(16)
-        captcha_sessions[session_id] = {
-            "session": session,
-            "csrf": csrf,
-            "created_at": datetime.now()
-        }
-        logger.info(f"Session created with ID: {session_id[:8]}...")
-
-        # Step 5: Return CAPTCHA image with session ID in header
-        response = StreamingResponse(BytesIO(captcha_response.content), media_type="image/jpeg")
-        response.headers["X-Session-ID"] = session_id
-        return response
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error in get_captcha: {e}")
-        raise HTTPException(status_code=500, detail="Network error while fetching CAPTCHA")
-    except Exception as e:
-        logger.error(f"Unexpected error in get_captcha: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error")
+    session_id = secrets.token_urlsafe(16)
+    session = erp_client()
+
+    # Step 1: Get initial page and CSRF token
+    logger.info("Fetching login page and CSRF token...")
+    res = await erp_request(session, "GET", ERP_LOGIN_URL)
+    csrf_match = CSRF_RE.search(res.content)
+    if not csrf_match:
+        raise HTTPException(status_code=500, detail="Failed to get CSRF token")
+    csrf = csrf_match.group(1).decode()
+
+    # Step 2: Trigger CAPTCHA with a dummy POST request
+    logger.info("Triggering CAPTCHA with a dummy request...")
+    dummy_data = {"_csrf": csrf, "LoginForm[username]": "", "LoginForm[password]": ""}
+    res_post = await erp_request(session, "POST", ERP_LOGIN_URL, data=dummy_data)
+
+    # Step 3: Extract CAPTCHA URL from the new page content
+    captcha_img_match = CAPTCHA_IMG_RE.search(res_post.content)
+    if not captcha_img_match:
+         raise HTTPException(status_code=500, detail="CAPTCHA image not found after trigger.")
+
+    captcha_url = ERP_BASE_URL + captcha_img_match.group(1).decode().replace("&amp;", "&")
+    logger.info(f"Fetching CAPTCHA from: {captcha_url}")
+    captcha_response = await erp_request(session, "GET", captcha_url)
+
+    # Step 4: Store session
+    captcha_sessions[session_id] = {
+        "cookies": [
+            (cookie.name, cookie.value, cookie.domain, cookie.path)
+            for cookie in session.cookies.jar
+        ],
+        "csrf": csrf,
+        "expires_at": time.monotonic() + SESSION_TTL,
+    }
+    if len(captcha_sessions) > MAX_CAPTCHA_SESSIONS:
+        captcha_sessions.popitem(last=False)
+    logger.info(f"Session created with ID: {session_id[:8]}...")
+
+    # Step 5: Return CAPTCHA image with session ID in header
+    return Response(
+        content=captcha_response.content,
+        media_type="image/jpeg",
+        headers={"X-Session-ID": session_id},
+    )
 
 # ------------------ LOGIN + FETCH TIMETABLE (Original Endpoint) ------------------
 @app.post("/fetch-timetable")
-def fetch_timetable(
+@upstream_error_boundary("Network error while fetching timetable")
+async def fetch_timetable(
     username: str = Form(...),
     password: str = Form(...),
     captcha: str = Form(...),
@@ -126,64 +253,52 @@ def fetch_timetable(
     academic_year_code: str = Form(default="19"),
     semester_id: str = Form(default="1")
 ):
-    if session_id not in captcha_sessions:
+    session_data = captcha_sessions.pop(session_id, None)
+    if session_data is None or session_data["expires_at"] <= time.monotonic():
         raise HTTPException(status_code=400, detail="Invalid or expired session.")
 
-    session_data = captcha_sessions[session_id]
-    session = session_data["session"]
+    session = erp_client(session_data["cookies"])
     csrf = session_data["csrf"]
-    base_url = "https://newerp.kluniversity.in"
-    login_url = f"{base_url}/index.php?r=site%2Flogin"
-    headers = {"User-Agent": "Mozilla/5.0"}
     
-    try:
-        login_payload = {
-            "_csrf": csrf,
-            "LoginForm[username]": username,
-            "LoginForm[password]": password,
-            "LoginForm[captcha]": captcha,
-        }
-        login_response = session.post(login_url, data=login_payload, headers=headers, timeout=30)
-        login_response.raise_for_status()
-        
-        if "Logout" not in login_response.text:
-            raise HTTPException(status_code=400, detail="Invalid credentials or captcha")
+    login_payload = {
+        "_csrf": csrf,
+        "LoginForm[username]": username,
+        "LoginForm[password]": password,
+        "LoginForm[captcha]": captcha,
+    }
+    login_response = await erp_request(session, "POST", ERP_LOGIN_URL, data=login_payload)
+    
+    if b"Logout" not in login_response.content:
+        raise HTTPException(status_code=400, detail="Invalid credentials or captcha")
 
-        logger.info(f"Fetching timetable for user: {username}")
-        tt_url = f"{base_url}/index.php?r=timetables%2Funiversitymasteracademictimetableview%2Findividualstudenttimetableget&UniversityMasterAcademicTimetableView%5Bacademicyear%5D={academic_year_code}&UniversityMasterAcademicTimetableView%5Bsemesterid%5D={semester_id}"
-        tt_response = session.get(tt_url, headers=headers, timeout=30)
-        tt_response.raise_for_status()
-        
-        soup_tt = BeautifulSoup(tt_response.text, "html.parser")
-        table = soup_tt.find("table")
-        if not table:
-            raise HTTPException(status_code=404, detail="Timetable not found")
-
-        thead = table.find("thead")
-        headers = [th.text.strip() for th in thead.find_all("th")][1:]
-        tbody = table.find("tbody")
-        timetable = {}
-        for row in tbody.find_all("tr"):
-            cols = row.find_all("td")
-            day = cols[0].text.strip()
-            slots = [td.text.strip() for td in cols[1:]]
-            timetable[day] = dict(zip(headers, slots))
-        
-        return {"success": True, "timetable": timetable}
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error in fetch_timetable: {e}")
-        raise HTTPException(status_code=500, detail="Network error while fetching timetable")
-    except Exception as e:
-        logger.error(f"Unexpected error in fetch_timetable: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        if session_id in captcha_sessions:
-            del captcha_sessions[session_id]
+    logger.info(f"Fetching timetable for user: {username}")
+    tt_params = {
+        "r": ERP_TIMETABLE_ROUTE,
+        "UniversityMasterAcademicTimetableView[academicyear]": academic_year_code,
+        "UniversityMasterAcademicTimetableView[semesterid]": semester_id,
+    }
+    tt_response = await erp_request(session, "GET", ERP_INDEX_URL, params=tt_params)
+    
+    doc = lhtml.document_fromstring(table_region(tt_response.content), parser=HTML_PARSER)
+    table = doc.find(".//table")
+    if table is None:
+        raise HTTPException(status_code=404, detail="Timetable not found")
+
+    col_headers = [th.text_content().strip() for th in TABLE_HEADER_CELLS(table)][1:]
+    # One text list per row (day first, then its slots); iterchildren()
+    # walks the <td>s in C without compiling an XPath per row
+    rows = (
+        [td.text_content().strip() for td in row.iterchildren("td")]
+        for row in TABLE_BODY_ROWS(table)
+    )
+    timetable = {cells[0]: dict(zip(col_headers, cells[1:])) for cells in rows}
+    
+    return {"success": True, "timetable": timetable}
 
 # ------------------ NEW: FETCH ATTENDANCE ROUTE ------------------
 @app.post("/fetch-attendance")
-def fetch_attendance(
+@upstream_error_boundary("A network error occurred.", "An internal server error occurred.")
+async def fetch_attendance(
     username: str = Form(...),
     password: str = Form(...),
     captcha: str = Form(...),
@@ -191,81 +306,72 @@ def fetch_attendance(
     academic_year_code: str = Form(...),
     semester_id: str = Form(...)
 ):
-    if session_id not in captcha_sessions:
+    session_data = captcha_sessions.pop(session_id, None)
+    if session_data is None or session_data["expires_at"] <= time.monotonic():
         raise HTTPException(status_code=400, detail="Invalid or expired session. Please refresh and try again.")
 
-    session_data = captcha_sessions[session_id]
-    session = session_data["session"]
+    session = erp_client(session_data["cookies"])
     csrf = session_data["csrf"]
-    base_url = "https://newerp.kluniversity.in"
-    login_url = f"{base_url}/index.php?r=site%2Flogin"
-    headers = {"User-Agent": "Mozilla/5.0"}
 
-    try:
-        # Step 1: Login
-        login_payload = {
-            "_csrf": csrf,
-            "LoginForm[username]": username,
-            "LoginForm[password]": password,
-            "LoginForm[captcha]": captcha,
-        }
-        login_response = session.post(login_url, data=login_payload, headers=headers, timeout=30)
-        login_response.raise_for_status()
-
-        if "Logout" not in login_response.text:
-            raise HTTPException(status_code=400, detail="Invalid credentials or captcha")
-
-        logger.info(f"Login successful for user: {username}")
-
-        # Step 2: Fetch Attendance Data
-        attendance_url = f"{base_url}/index.php?r=studentattendance%2Fstudentdailyattendance%2Fcourselist"
-        post_login_soup = BeautifulSoup(login_response.text, "html.parser")
-        post_login_csrf_meta = post_login_soup.find("meta", {"name": "csrf-token"})
-        if not post_login_csrf_meta:
-            raise HTTPException(status_code=500, detail="Could not find CSRF token on post-login page.")
-        post_login_csrf = post_login_csrf_meta["content"]
-
-        attendance_payload = {
-            "_csrf": post_login_csrf,
-            "DynamicModel[academicyear]": academic_year_code,
-            "DynamicModel[semesterid]": semester_id,
-        }
-        attendance_response = session.post(attendance_url, data=attendance_payload, headers=headers, timeout=30)
-        attendance_response.raise_for_status()
-        
-        # Step 3: Parse the Attendance HTML
-        attendance_soup = BeautifulSoup(attendance_response.text, "html.parser")
-        container = attendance_soup.find("div", class_="grid-view")
-        if not container:
-             raise HTTPException(status_code=404, detail="Could not find the attendance data container on the page.")
-
-        table = container.find("table")
-        if not table:
-            raise HTTPException(status_code=404, detail="Could not find the attendance table within the container.")
-
-        table_headers = [th.text.strip() for th in table.find("thead").find_all("th")]
-        attendance_data = []
-        for row in table.find("tbody").find_all("tr"):
-            cells = row.find_all("td")
-            if not cells: continue
-            
-            row_data = {table_headers[i]: cells[i].text.strip() for i in range(len(cells))}
-            attendance_data.append(row_data)
-
-        if not attendance_data:
-             return {"success": True, "message": "No attendance data found for the selected period.", "attendance": []}
-
-        return {"success": True, "attendance": attendance_data}
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during attendance fetch: {e}")
-        raise HTTPException(status_code=500, detail="A network error occurred.")
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="An internal server error occurred.")
-    finally:
-        if session_id in captcha_sessions:
-            del captcha_sessions[session_id]
-            logger.info(f"Session {session_id[:8]}... cleaned up.")
+    # Step 1: Login
+    login_payload = {
+        "_csrf": csrf,
+        "LoginForm[username]": username,
+        "LoginForm[password]": password,
+        "LoginForm[captcha]": captcha,
+    }
+    login_response = await erp_request(session, "POST", ERP_LOGIN_URL, data=login_payload)
+
+    if b"Logout" not in login_response.content:
+        raise HTTPException(status_code=400, detail="Invalid credentials or captcha")
+
+    logger.info(f"Login successful for user: {username}")
+
+    # Step 2: Fetch Attendance Data
+    post_login_csrf_match = CSRF_RE.search(login_response.content)
+    if not post_login_csrf_match:
+        raise HTTPException(status_code=500, detail="Could not find CSRF token on post-login page.")
+    post_login_csrf = post_login_csrf_match.group(1).decode()
+
+    attendance_payload = {
+        "_csrf": post_login_csrf,
+        "DynamicModel[academicyear]": academic_year_code,
+        "DynamicModel[semesterid]": semester_id,
+    }
+    attendance_response = await erp_request(session, "POST", ERP_ATTENDANCE_URL, data=attendance_payload)
+    
+    # Step 3: Parse the Attendance HTML
+    doc = lhtml.document_fromstring(
+        table_region(attendance_response.content, b'class="grid-view'), parser=HTML_PARSER
+    )
+    containers = GRID_VIEW_DIVS(doc)
+    if not containers:
+         raise HTTPException(status_code=404, detail="Could not find the attendance data container on the page.")
+
+    table = containers[0].find(".//table")
+    if table is None:
+        raise HTTPException(status_code=404, detail="Could not find the attendance table within the container.")
+
+    table_headers = [th.text_content().strip() for th in TABLE_HEADER_CELLS(table)]
+    rows = (
+        [td.text_content().strip() for td in row.iterchildren("td")]
+        for row in TABLE_BODY_ROWS(table)
+    )
+    attendance_data = [dict(zip(table_headers, cells)) for cells in rows if cells]
+
+    if not attendance_data:
+         return {"success": True, "message": "No attendance data found for the selected period.", "attendance": []}
+
+    return {"success": True, "attendance": attendance_data}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Single worker on purpose: captcha_sessions lives in this process
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+    )
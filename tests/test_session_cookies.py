@@ -0,0 +1,80 @@
+import unittest
+from urllib.parse import parse_qs
+
+import httpx
+from fastapi.testclient import TestClient
+
+import main
+
+LOGIN_PAGE = b'<html><head><meta name="csrf-token" content="tok"></head><body></body></html>'
+CAPTCHA_PAGE = b'<img src="/index.php?r=site%2Fcaptcha&amp;v=1">'
+TIMETABLE_PAGE = (
+    b"<table><thead><tr><th>Day</th><th>9:00</th></tr></thead>"
+    b"<tbody><tr><td>MON</td><td>Maths</td></tr></tbody></table>"
+)
+
+
+class FakeErp:
+    """Mimics Yii2 regenerating PHPSESSID when the login POST succeeds."""
+
+    def __init__(self):
+        self.cookie_headers = []
+
+    def __call__(self, request):
+        cookie = request.headers.get("cookie")
+        self.cookie_headers.append((request.method, request.url.params.get("r"), cookie))
+        route = request.url.params.get("r")
+
+        if route == "site/login" and request.method == "GET":
+            return httpx.Response(200, content=LOGIN_PAGE, headers={"Set-Cookie": "PHPSESSID=A; path=/"})
+        if route == "site/login":
+            form = parse_qs(request.content.decode())
+            if not form.get("LoginForm[captcha]"):
+                return httpx.Response(200, content=CAPTCHA_PAGE)
+            return httpx.Response(
+                302,
+                headers={
+                    "Location": "/index.php?r=site%2Findex",
+                    "Set-Cookie": "PHPSESSID=B; path=/",
+                },
+            )
+        if route == "site/captcha":
+            return httpx.Response(200, content=b"\xff\xd8jpeg")
+        if cookie != "PHPSESSID=B":
+            return httpx.Response(200, content=LOGIN_PAGE)
+        if route == "site/index":
+            return httpx.Response(200, content=b"<a>Logout</a>")
+        if route == main.ERP_TIMETABLE_ROUTE:
+            return httpx.Response(200, content=TIMETABLE_PAGE)
+        return httpx.Response(404)
+
+
+class SessionCookieTest(unittest.TestCase):
+    def setUp(self):
+        self.erp = FakeErp()
+        main.app.state.erp_transport = httpx.MockTransport(self.erp)
+        main.captcha_sessions.clear()
+        self.client = TestClient(main.app)
+
+    def test_login_replaces_regenerated_phpsessid(self):
+        captcha = self.client.get("/get-captcha")
+        self.assertEqual(captcha.status_code, 200)
+
+        response = self.client.post(
+            "/fetch-timetable",
+            data={
+                "username": "u",
+                "password": "p",
+                "captcha": "c",
+                "session_id": captcha.headers["X-Session-ID"],
+            },
+        )
+
+        self.assertEqual(response.status_code, 200, response.text)
+        self.assertEqual(response.json()["timetable"], {"MON": {"9:00": "Maths"}})
+        after_login = [c for m, r, c in self.erp.cookie_headers if r != "site/login" and r != "site/captcha"]
+        self.assertEqual(after_login, ["PHPSESSID=B", "PHPSESSID=B"])
+
+
+if __name__ == "__main__":
+    unittest.main()